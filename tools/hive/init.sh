@@ -96,7 +96,7 @@ fi
 # Venv for the bot service
 if [ ! -d "$HIVE_DIR/venv" ]; then
     python3 -m venv "$HIVE_DIR/venv"
-    "$HIVE_DIR/venv/bin/pip" install -q python-telegram-bot aiofiles
+    "$HIVE_DIR/venv/bin/pip" install -q python-telegram-bot orjson uvloop
     echo -e "${GREEN}[OK]${NC} Python venv created"
 else
     echo -e "${YELLOW}[SKIP]${NC} Python venv exists"
@@ -298,7 +298,6 @@ fi
 
 log_info "Installing agent tools..."
 mkdir -p "$CONFIG_DIR/tools"
-mkdir -p "$CONFIG_DIR/pending_prompts"
 mkdir -p "$CONFIG_DIR/ralph2/skills/prd"
 mkdir -p "$CONFIG_DIR/ralph2/skills/ralph"
 mkdir -p "$CONFIG_DIR/ralph2/skills/ralph-tasks"
@@ -357,7 +356,7 @@ log_success "Codex skills -> $CODEX_SKILLS_DIR"
 # Telegram bot service
 cp "$SCRIPT_DIR/tools/telegram-bot/agent_telegram_bot.py" "$CONFIG_DIR/"
 python3 -m venv "$CONFIG_DIR/venv"
-"$CONFIG_DIR/venv/bin/pip" install -q python-telegram-bot aiofiles
+"$CONFIG_DIR/venv/bin/pip" install -q python-telegram-bot orjson uvloop
 cp "$SCRIPT_DIR/tools/telegram-bot/agent-telegram-bot.service" /etc/systemd/system/
 systemctl daemon-reload
 
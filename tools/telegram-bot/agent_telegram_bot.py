@@ -8,48 +8,124 @@ import asyncio
 import json
 import logging
 import os
+import re
 import sys
 import socket
 import time
+from collections import deque
 from pathlib import Path
-from datetime import datetime
 from typing import Optional
 
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+try:
+    import orjson
+except ImportError:  # Fall back to stdlib json if the wheel isn't installed
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # Use the default asyncio event loop
+    uvloop = None
+
 # Configuration
 CONFIG_DIR = Path("/etc/hive")
 CONFIG_FILE = CONFIG_DIR / "telegram_config.json"
 SOCKET_PATH = "/tmp/agent_telegram_bot.sock"
-PENDING_DIR = CONFIG_DIR / "pending_prompts"
+MAX_REQUEST_SIZE = 1024 * 1024  # bytes per newline-terminated request
+MAX_CONNECTIONS = 256           # open socket connections; extra ones are dropped
+READ_TIMEOUT = 10               # seconds for a client to send its request line
+SOCKET_BACKLOG = 512
+ALERT_COALESCE_DELAY = 0.1  # seconds to wait for more alerts before sending
+MAX_MESSAGE_LENGTH = 4096   # Telegram's limit for a single message, in UTF-16 units
 
 # Logging setup
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# The format above doesn't use thread or process info; skip collecting it
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 logger = logging.getLogger(__name__)
 
+class StatusEmojiMap(dict):
+    """Status to emoji mapping that falls back to the info emoji."""
+
+    def __missing__(self, status):
+        # Unlike defaultdict, don't store unknown statuses sent by clients
+        return "\u2139\ufe0f"
+
+
 # Status emoji mapping
-STATUS_EMOJI = {
+STATUS_EMOJI = StatusEmojiMap({
     "success": "\u2705",  # Green check
     "info": "\u2139\ufe0f",      # Info
     "warning": "\u26a0\ufe0f",   # Warning
     "error": "\u274c",           # Red X
-}
+})
+
+
+# Characters with special meaning in Telegram's legacy Markdown
+MARKDOWN_SPECIAL = re.compile(r"([_*`\[])")
+
+
+def escape_markdown(text: str) -> str:
+    """Escape text so Telegram's Markdown parser shows it literally."""
+    return MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+
+def escape_markdown_bold(text: str) -> str:
+    """Escape text placed inside a *bold* entity."""
+    # Escapes aren't allowed inside an entity: close it, escape, reopen
+    return text.replace("*", "*\\**")
+
+
+def utf16_len(text: str) -> int:
+    """Length of text as Telegram counts it (UTF-16 code units)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def json_dumps(obj, indent: bool = False) -> bytes:
+    """Serialize obj to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode()
+
+
+def json_loads(data: bytes):
+    """Deserialize JSON bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Pre-encoded replies for malformed socket requests
+INVALID_REQUEST_REPLY = json_dumps({"success": False, "error": "Request must be a JSON object"})
+REQUEST_TOO_LARGE_REPLY = json_dumps({
+    "success": False,
+    "error": f"Request exceeds {MAX_REQUEST_SIZE} bytes"
+})
+
 
 class AgentTelegramBot:
     def __init__(self):
+        self.saved_config: Optional[bytes] = None  # last bytes written by save_config
         self.config = self.load_config()
         self.application: Optional[Application] = None
-        self.pending_responses: dict = {}
+        self.pending_responses: dict = {}  # prompt message id (int) -> Future[str]
+        self.queued_alerts: deque = deque()  # (message, Future[dict])
+        self.alert_flush_task: Optional[asyncio.Task] = None
+        self.open_connections = 0
 
     def load_config(self) -> dict:
         """Load configuration from JSON file."""
         if CONFIG_FILE.exists():
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+            self.saved_config = CONFIG_FILE.read_bytes()
+            return json_loads(self.saved_config)
         return {
             "bot_token": "",
             "chat_id": "",
@@ -57,10 +133,25 @@ class AgentTelegramBot:
         }
 
     def save_config(self):
-        """Save configuration to JSON file."""
+        """Save configuration to JSON file atomically, skipping unchanged writes."""
+        data = json_dumps(self.config, indent=True)
+        if data == self.saved_config:
+            return
+
         CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(self.config, f, indent=2)
+        tmp_file = CONFIG_FILE.with_suffix(".tmp")
+        # Config holds the bot token: keep it owner-only, as tgsetup does
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, CONFIG_FILE)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+        self.saved_config = data
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command."""
@@ -74,105 +165,186 @@ class AgentTelegramBot:
         if not update.message or not update.message.text:
             return
 
+        # Message ids are only unique per chat: ignore anything but the bound chat
+        if str(update.message.chat_id) != str(self.config.get("chat_id", "")):
+            return
+
         text = update.message.text.strip()
-        chat_id = str(update.message.chat_id)
         reply_to = update.message.reply_to_message
 
         # Handle replies to prompt messages
         if reply_to and reply_to.message_id:
-            prompt_id = str(reply_to.message_id)
-            response_file = PENDING_DIR / f"{prompt_id}.response"
-
-            # Write response to file
-            PENDING_DIR.mkdir(parents=True, exist_ok=True)
-            with open(response_file, 'w') as f:
-                f.write(text)
+            prompt_id = reply_to.message_id
+            future = self.pending_responses.pop(prompt_id, None)
+            if future is None or future.done():
+                await update.message.reply_text("\u26a0\ufe0f No pending prompt for that message")
+                return
 
+            future.set_result(text)
             await update.message.reply_text("\u2705 Response recorded!")
-            logger.info(f"Response recorded for prompt {prompt_id}")
+            logger.info("Response recorded for prompt %s", prompt_id)
 
     async def send_alert(self, title: str, description: str, codeblock: str, status: str) -> dict:
         """Send an alert message to the bound chat."""
         if not self.config["bound"]:
             return {"success": False, "error": "Bot not bound to any chat"}
 
-        emoji = STATUS_EMOJI.get(status, "\u2139\ufe0f")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        message = f"{emoji} *{title}*\n\n"
-        message += f"\u23f0 {timestamp}\n\n"
+        emoji = STATUS_EMOJI[status]
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
 
+        parts = [f"{emoji} *{escape_markdown_bold(title)}*\n\n\u23f0 {timestamp}\n\n"]
         if description:
-            message += f"{description}\n\n"
-
+            parts.append(f"{escape_markdown(description)}\n\n")
         if codeblock:
-            message += f"```\n{codeblock}\n```"
-
+            parts.append(f"```\n{codeblock}\n```")
+        message = "".join(parts)
+
+        # Errors go out immediately; everything else may be merged with
+        # alerts that arrive within ALERT_COALESCE_DELAY
+        if status == "error":
+            return await self.deliver_alert(message)
+
+        future = asyncio.get_running_loop().create_future()
+        self.queued_alerts.append((message, future))
+        if self.alert_flush_task is None:
+            self.alert_flush_task = asyncio.create_task(self.flush_alerts())
+        return await future
+
+    async def deliver_alert(self, message: str) -> dict:
+        """Send a single alert message to the bound chat."""
         try:
-            await self.application.bot.send_message(
-                chat_id=self.config["chat_id"],
-                text=message,
-                parse_mode="Markdown"
-            )
+            await self.send_markdown(message)
             return {"success": True}
         except Exception as e:
-            logger.error(f"Failed to send alert: {e}")
+            logger.error("Failed to send alert: %s", e)
             return {"success": False, "error": str(e)}
 
+    async def send_markdown(self, text: str):
+        """Send a Markdown message to the bound chat."""
+        return await self.application.bot.send_message(
+            chat_id=self.config["chat_id"],
+            text=text,
+            parse_mode="Markdown"
+        )
+
+    async def flush_alerts(self):
+        """Send queued alerts, merging as many as fit in one message."""
+        try:
+            await asyncio.sleep(ALERT_COALESCE_DELAY)
+            while self.queued_alerts:
+                batch = [self.queued_alerts.popleft()]
+                length = utf16_len(batch[0][0])
+                while self.queued_alerts:
+                    message_length = utf16_len(self.queued_alerts[0][0])
+                    if length + 2 + message_length > MAX_MESSAGE_LENGTH:
+                        break
+                    batch.append(self.queued_alerts.popleft())
+                    length += 2 + message_length
+
+                if len(batch) == 1:
+                    results = [await self.deliver_alert(batch[0][0])]
+                else:
+                    try:
+                        await self.send_markdown(
+                            "\n\n".join(message.rstrip("\n") for message, _ in batch)
+                        )
+                        results = [{"success": True}] * len(batch)
+                    except BadRequest as e:
+                        # Telegram rejected the merged text (e.g. one malformed alert):
+                        # nothing was delivered, so send each alert on its own
+                        logger.warning("Merged alert rejected, resending individually: %s", e)
+                        results = [await self.deliver_alert(message) for message, _ in batch]
+                    except Exception as e:
+                        # Timeouts and network errors may still have delivered the
+                        # message; report the failure rather than risk duplicates
+                        logger.error("Failed to send alert: %s", e)
+                        results = [{"success": False, "error": str(e)}] * len(batch)
+
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self.alert_flush_task = None
+
     async def send_prompt(self, title: str, description: str, codeblock: str, status: str, timeout: int) -> dict:
         """Send a prompt message and wait for reply."""
         if not self.config["bound"]:
             return {"success": False, "error": "Bot not bound to any chat"}
 
-        emoji = STATUS_EMOJI.get(status, "\u2139\ufe0f")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        message = f"{emoji} *{title}* (Reply required)\n\n"
-        message += f"\u23f0 {timestamp}\n"
-        message += f"\u23f3 Timeout: {timeout}s\n\n"
+        emoji = STATUS_EMOJI[status]
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
 
+        parts = [f"{emoji} *{escape_markdown_bold(title)}* (Reply required)\n\n\u23f0 {timestamp}\n\u23f3 Timeout: {timeout}s\n\n"]
         if description:
-            message += f"{description}\n\n"
-
+            parts.append(f"{escape_markdown(description)}\n\n")
         if codeblock:
-            message += f"```\n{codeblock}\n```\n\n"
-
-        message += "_Reply to this message with your response_"
+            parts.append(f"```\n{codeblock}\n```\n\n")
+        parts.append("_Reply to this message with your response_")
+        message = "".join(parts)
 
         try:
-            sent_message = await self.application.bot.send_message(
-                chat_id=self.config["chat_id"],
-                text=message,
-                parse_mode="Markdown"
-            )
-
-            prompt_id = str(sent_message.message_id)
-            response_file = PENDING_DIR / f"{prompt_id}.response"
-
-            # Wait for response with timeout
-            start_time = time.time()
-            while time.time() - start_time < timeout:
-                if response_file.exists():
-                    with open(response_file, 'r') as f:
-                        response = f.read()
-                    response_file.unlink()  # Clean up
-                    return {"success": True, "response": response}
-                await asyncio.sleep(1)
-
-            return {"success": False, "error": "Timeout waiting for response", "timeout": True}
+            sent_message = await self.send_markdown(message)
+
+            prompt_id = sent_message.message_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending_responses[prompt_id] = future
+
+            # Wait for handle_message to resolve the reply, with timeout
+            try:
+                response = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return {"success": False, "error": "Timeout waiting for response", "timeout": True}
+            finally:
+                self.pending_responses.pop(prompt_id, None)
+
+            return {"success": True, "response": response}
 
         except Exception as e:
-            logger.error(f"Failed to send prompt: {e}")
+            logger.error("Failed to send prompt: %s", e)
             return {"success": False, "error": str(e)}
 
     async def handle_socket_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Handle incoming socket requests from alertme/promptme scripts."""
+        # Each connection can buffer up to 2 * MAX_REQUEST_SIZE of input, so cap
+        # how many are open instead of queueing them behind one another
+        if self.open_connections >= MAX_CONNECTIONS:
+            logger.warning("Too many socket connections, dropping new one")
+            writer.transport.abort()
+            return
+
+        self.open_connections += 1
         try:
-            data = await reader.read(65536)
+            # Requests are a single line of JSON; the limit is enforced by the reader
+            try:
+                data = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Socket client sent no request within %ss", READ_TIMEOUT)
+                return
+            except ValueError:
+                # Consume the rest of the oversized line first: closing with unread
+                # input resets the connection and the client would lose the reply
+                try:
+                    await asyncio.wait_for(self.discard_line(reader), READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                await self.send_result(writer, REQUEST_TOO_LARGE_REPLY)
+                return
             if not data:
                 return
 
-            request = json.loads(data.decode())
+            # Nothing else is expected from the client: stop buffering its input
+            # while the action runs (prompts can take minutes)
+            writer.transport.pause_reading()
+
+            try:
+                request = json_loads(data)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                logger.warning("Rejected malformed socket request")
+                await self.send_result(writer, INVALID_REQUEST_REPLY)
+                return
+
             action = request.get("action")
 
             if action == "alert":
@@ -199,19 +371,31 @@ class AgentTelegramBot:
             else:
                 result = {"success": False, "error": f"Unknown action: {action}"}
 
-            writer.write(json.dumps(result).encode())
-            await writer.drain()
+            await self.send_result(writer, result)
 
         except Exception as e:
-            logger.error(f"Socket request error: {e}")
+            logger.error("Socket request error: %s", e)
             try:
-                writer.write(json.dumps({"success": False, "error": str(e)}).encode())
-                await writer.drain()
-            except:
-                pass
+                await self.send_result(writer, {"success": False, "error": str(e)})
+            except Exception:
+                # Client is gone; drop the connection instead of closing gracefully
+                writer.transport.abort()
         finally:
+            self.open_connections -= 1
+            # One-shot reply: let the transport finish closing on its own
             writer.close()
-            await writer.wait_closed()
+
+    async def discard_line(self, reader: asyncio.StreamReader):
+        """Read and drop input up to the next newline or EOF."""
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk or b"\n" in chunk:
+                return
+
+    async def send_result(self, writer: asyncio.StreamWriter, result):
+        """Write a JSON reply (a dict or pre-encoded bytes) to a socket client."""
+        writer.write(result if isinstance(result, bytes) else json_dumps(result))
+        await writer.drain()
 
     async def start_socket_server(self):
         """Start Unix socket server for IPC."""
@@ -221,13 +405,15 @@ class AgentTelegramBot:
 
         server = await asyncio.start_unix_server(
             self.handle_socket_request,
-            path=SOCKET_PATH
+            path=SOCKET_PATH,
+            limit=MAX_REQUEST_SIZE,
+            backlog=SOCKET_BACKLOG
         )
 
         # Make socket accessible
         os.chmod(SOCKET_PATH, 0o666)
 
-        logger.info(f"Socket server started at {SOCKET_PATH}")
+        logger.info("Socket server started at %s", SOCKET_PATH)
 
         async with server:
             await server.serve_forever()
@@ -238,9 +424,6 @@ class AgentTelegramBot:
             logger.error("No bot token configured. Run telegram-bot-setup first.")
             sys.exit(1)
 
-        # Create pending prompts directory
-        PENDING_DIR.mkdir(parents=True, exist_ok=True)
-
         # Build application
         self.application = Application.builder().token(self.config["bot_token"]).build()
 
@@ -278,7 +461,10 @@ class AgentTelegramBot:
 
 def main():
     bot = AgentTelegramBot()
-    asyncio.run(bot.run())
+    if uvloop is not None:
+        uvloop.run(bot.run())
+    else:
+        asyncio.run(bot.run())
 
 
 if __name__ == "__main__":